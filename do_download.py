@@ -1,9 +1,14 @@
-import requests
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import aiohttp
+import aiofiles
 from tqdm import tqdm
 import random
-from bs4 import BeautifulSoup
 import argparse
 import os
+import re
+import time
 
 # Base URL for Project Gutenberg's plain text files
 BASE_URL = "https://www.gutenberg.org/files/{}/{}-0.txt"
@@ -11,63 +16,202 @@ BASE_URL = "https://www.gutenberg.org/files/{}/{}-0.txt"
 # URL to fetch a list of recent eBooks (we'll use this to find random book IDs)
 RECENT_EBOOKS_URL = "https://www.gutenberg.org/ebooks/search/?sort_order=random"
 
+# Content-Range of a single-range 206 response: bytes <first>-<last>/<size or *>
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+# Book links on the search page: <li class="booklink"> <a ... href="/ebooks/12345">
+BOOK_ID_PATTERN = re.compile(rb'class="booklink"[^<]*<a[^>]+href="/ebooks/(\d+)"')
+
 # Folder to save downloaded books
 DOWNLOAD_FOLDER = "./data/original_text"
 
+# Folder for books that are still being downloaded, kept apart from the finished books
+PARTIAL_FOLDER = "./data/partial_text"
+
+# Folder to save the token IDs of books tokenized while downloading
+ENCODED_FOLDER = "./data/encoded_text"
+
+# Cache for the search page (opt-in with --cache), so reruns within an hour do not refetch it
+HTTP_CACHE_FILE = "./data/.http_cache/random_ebooks.html"
+HTTP_CACHE_EXPIRE_AFTER = 3600  # seconds
+
+# Maximum number of books downloaded at the same time
+MAX_CONCURRENT_DOWNLOADS = 8
+
+# Size of the keep-alive connection pool shared by all requests
+CONNECTION_POOL_SIZE = 16
+
+# Bytes read from the network per iteration and size of the file write buffer
+CHUNK_SIZE = 256 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Maximum number of downloaded books waiting to be tokenized
+PIPELINE_QUEUE_SIZE = 4
+
+
+async def load_cache(cache_file):
+    """
+    Returns the contents of cache_file, or None if it is missing or older
+    than HTTP_CACHE_EXPIRE_AFTER seconds.
+    """
+    if not os.path.exists(cache_file) or time.time() - os.path.getmtime(cache_file) >= HTTP_CACHE_EXPIRE_AFTER:
+        return None
+    async with aiofiles.open(cache_file, "rb") as file:
+        return await file.read()
+
+
+async def save_cache(cache_file, body):
+    """
+    Stores body in cache_file.
+    """
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    async with aiofiles.open(cache_file, "wb") as file:
+        await file.write(body)
+
 
-def fetch_random_book_ids(num_books):
+async def fetch_random_book_ids(session, num_books, use_cache=False):
     """
     Fetches a list of random book IDs from Project Gutenberg's recent eBooks page.
+    If use_cache is True, the page is served from HTTP_CACHE_FILE while it is
+    fresh, so reruns reuse the same book IDs instead of fetching new random ones.
     """
     try:
-        response = requests.get(RECENT_EBOOKS_URL)
-        response.raise_for_status()  # Raise an error for bad status codes
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        # Find all book links (they are in <li> tags with class 'booklink')
-        book_links = soup.find_all("li", class_="booklink")
-        book_ids = []
-
-        # Extract book IDs from the links
-        for link in book_links:
-            book_id = link.find("a")["href"].split("/")[-1]
-            if book_id.isdigit():  # Ensure it's a valid numeric ID
-                book_ids.append(int(book_id))
-            if len(book_ids) >= num_books * 2:  # Fetch extra IDs to account for failures
-                break
-
-        return book_ids
+        html = await load_cache(HTTP_CACHE_FILE) if use_cache else None
+        if html is None:
+            async with session.get(RECENT_EBOOKS_URL) as response:
+                response.raise_for_status()  # Raise an error for bad status codes
+                html = await response.read()
+            # Only cache a page that actually lists books
+            if use_cache and BOOK_ID_PATTERN.search(html):
+                await save_cache(HTTP_CACHE_FILE, html)
+
+        # Extract book IDs from the book links (fetch extra IDs to account for failures)
+        book_ids = BOOK_ID_PATTERN.findall(html)
+        return [int(book_id) for book_id in book_ids[:num_books * 2]]
     except Exception as e:
         print(f"Error fetching book IDs: {e}")
         return []
 
 
-def download_book(book_id, filepath):
+async def download_book(session, book_id, filepath, position=0):
     """
     Downloads a book from Project Gutenberg and saves it as a .txt file.
     Includes a progress bar using tqdm.
+    The book is written to a partial file first; if one is left over from an
+    interrupted download, only the missing bytes are requested. The ETag or
+    Last-Modified value of the book is kept next to the partial file and sent
+    as If-Range, so a book that changed on the server is downloaded again.
     Returns True if the download was successful, False otherwise.
     """
     url = BASE_URL.format(book_id, book_id)
-    response = requests.get(url, stream=True)
-    
-    if response.status_code == 200:
-        total_size = int(response.headers.get("content-length", 0))
-        with open(filepath, "wb") as file, tqdm(
-            desc=os.path.basename(filepath),
-            total=total_size,
-            unit="B",
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as progress_bar:
-            for data in response.iter_content(chunk_size=1024):
-                file.write(data)
-                progress_bar.update(len(data))
-        print(f"Downloaded: {filepath}")
-        return True
+    partial_filepath = generate_partial_filepath(book_id)
+    validator_filepath = partial_filepath + ".validator"
+    offset = os.path.getsize(partial_filepath) if os.path.exists(partial_filepath) else 0
+    validator = None
+    if os.path.exists(validator_filepath):
+        with open(validator_filepath, "r") as file:
+            validator = file.read()
+
+    # Ask for the raw bytes so a resumed download can be appended as is
+    headers = {"Accept-Encoding": "identity"}
+    if offset and validator:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
     else:
-        print(f"Failed to download book ID {book_id}. Status code: {response.status_code}")
+        offset = 0  # Without a validator the partial file cannot be trusted
+
+    try:
+        async with session.get(url, headers=headers) as response:
+            if response.status == 206 and is_remaining_range(response.headers.get("Content-Range", ""), offset):
+                mode = "ab"  # Resume after the bytes already on disk
+            elif response.status == 206:
+                # Not the range that was asked for; appending it would corrupt the book
+                print(f"Unexpected range for book ID {book_id}: {response.headers.get('Content-Range')}")
+                discard_partial(partial_filepath)
+                mode = None
+            elif response.status == 200:
+                mode = "wb"  # Server sent the whole book, start over
+                offset = 0
+                validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                if validator:
+                    with open(validator_filepath, "w") as file:
+                        file.write(validator)
+                elif os.path.exists(validator_filepath):
+                    os.remove(validator_filepath)
+            elif response.status == 416 and offset:
+                # Range not satisfiable: either the partial file already holds
+                # the whole book (Content-Range: bytes */<size>) or it is stale
+                content_range = response.headers.get("Content-Range", "")
+                if content_range == f"bytes */{offset}":
+                    return finish_download(partial_filepath, filepath)
+                discard_partial(partial_filepath)
+                print(f"Failed to download book ID {book_id}. Status code: {response.status}")
+                return False
+            else:
+                print(f"Failed to download book ID {book_id}. Status code: {response.status}")
+                return False
+
+            if mode is not None:
+                total_size = offset + int(response.headers.get("content-length", 0))
+                async with aiofiles.open(partial_filepath, mode, buffering=WRITE_BUFFER_SIZE) as file:
+                    with tqdm(
+                        desc=os.path.basename(filepath),
+                        total=total_size,
+                        initial=offset,
+                        unit="B",
+                        unit_scale=True,
+                        unit_divisor=1024,
+                        position=position,
+                    ) as progress_bar:
+                        async for data in response.content.iter_chunked(CHUNK_SIZE):
+                            await file.write(data)
+                            progress_bar.update(len(data))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Failed to download book ID {book_id}. Error: {e}")
+        return False
+
+    if mode is None:
+        # The partial file is gone, so a resumed download now starts over; a
+        # bad 206 to a request without a Range header is simply a failure
+        if offset:
+            return await download_book(session, book_id, filepath, position)
+        return False
+
+    return finish_download(partial_filepath, filepath)
+
+
+def is_remaining_range(content_range, offset):
+    """
+    Checks that a 206 Content-Range covers exactly the bytes from offset to the
+    end of the book, e.g. "bytes 1024-4095/4096" for offset 1024.
+    """
+    match = CONTENT_RANGE_PATTERN.fullmatch(content_range)
+    if not offset or not match or int(match.group(1)) != offset:
         return False
+    size = match.group(3)
+    return size == "*" or int(match.group(2)) == int(size) - 1
+
+
+def finish_download(partial_filepath, filepath):
+    """
+    Moves a completely downloaded partial file into place and removes its validator.
+    Returns True.
+    """
+    os.replace(partial_filepath, filepath)
+    validator_filepath = partial_filepath + ".validator"
+    if os.path.exists(validator_filepath):
+        os.remove(validator_filepath)
+    print(f"Downloaded: {filepath}")
+    return True
+
+
+def discard_partial(partial_filepath):
+    """
+    Deletes a partial file and its validator, if they exist.
+    """
+    for path in (partial_filepath, partial_filepath + ".validator"):
+        if os.path.exists(path):
+            os.remove(path)
 
 
 def generate_filepath(index):
@@ -79,42 +223,207 @@ def generate_filepath(index):
     return os.path.join(DOWNLOAD_FOLDER, filename)
 
 
-def download_books(book_ids, num_books, retry_count):
+def generate_partial_filepath(book_id):
     """
-    Downloads multiple books from Project Gutenberg.
-    If a book fails to download, it picks a different random book ID.
-    Ensures exactly `num_books` are downloaded.
+    Generates the filepath used while a book is being downloaded.
+    Example: ./data/partial_text/12345.part
     """
-    successful_downloads = 0
-    index = 1
+    filename = f"{book_id}.part"
+    return os.path.join(PARTIAL_FOLDER, filename)
+
 
-    while successful_downloads < num_books and book_ids:
-        book_id = book_ids.pop(0)  # Get the next book ID
+async def download_slot(session, semaphore, book_ids, index, retry_count, queue=None):
+    """
+    Downloads one book into the slot `index`.
+    If a book fails to download, it picks a different random book ID,
+    and keeps trying new IDs until the slot is filled or no IDs are left.
+    If a queue is given, the filepath of the downloaded book is put on it.
+    Returns True if the slot was filled, False otherwise.
+    """
+    async with semaphore:
         filepath = generate_filepath(index)
-        retries = 0
 
-        while retries <= retry_count:
-            if download_book(book_id, filepath):
-                successful_downloads += 1
-                index += 1
-                break
-            else:
+        while book_ids:
+            book_id = book_ids.pop(0)  # Get the next book ID
+            retries = 0
+
+            while retries <= retry_count:
+                if await download_book(session, book_id, filepath, position=index - 1):
+                    if queue is not None:
+                        await queue.put(filepath)
+                    return True
                 retries += 1
                 if retries <= retry_count:
-                    # Pick a different random book ID for the next attempt
-                    if book_ids:
+                    # Resume the same book if part of it was downloaded
+                    if os.path.exists(generate_partial_filepath(book_id)):
+                        print(f"Resuming book ID {book_id}...")
+                    # Otherwise pick a different random book ID for the next attempt
+                    elif book_ids:
                         book_id = book_ids.pop(0)
                         print(f"Retrying with a different book ID: {book_id}...")
                     else:
                         print("No more book IDs to try.")
-                        break
+                        return False
                 else:
                     print(f"Max retries reached. Skipping...")
+                    # This book will not be resumed, so don't leave its partial file behind
+                    discard_partial(generate_partial_filepath(book_id))
+        return False
+
+
+async def download_books(session, book_ids, num_books, retry_count, queue=None):
+    """
+    Downloads multiple books from Project Gutenberg concurrently.
+    At most MAX_CONCURRENT_DOWNLOADS books are fetched at the same time.
+    Ensures exactly `num_books` are downloaded.
+    If a queue is given, each downloaded filepath is put on it as soon as it is ready.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    results = await asyncio.gather(
+        *[download_slot(session, semaphore, book_ids, index, retry_count, queue)
+          for index in range(1, num_books + 1)],
+        return_exceptions=True,
+    )
+
+    successful_downloads = 0
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Error while downloading: {result}")
+        elif result:
+            successful_downloads += 1
 
     if successful_downloads < num_books:
         print(f"Warning: Only {successful_downloads} out of {num_books} books were downloaded.")
 
 
+def init_tokenize_worker():
+    """
+    Disables parallelism inside a tokenize worker process.
+    The books are already spread over worker processes, so nested process
+    pools or Rayon threads would only oversubscribe the CPUs.
+    """
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    os.environ["RAYON_NUM_THREADS"] = "1"
+    import do_tokenize
+    do_tokenize.MAX_WORKERS = 1
+
+
+def tokenize_book(filepath, tokenizer_type):
+    """
+    Encodes all lines of a downloaded book with the specified tokenizer and
+    saves the token IDs to ENCODED_FOLDER, one line of space-separated IDs per text line.
+    Runs in a worker process; returns the number of lines, the number of tokens
+    and the path of the encoded file.
+    """
+    # Imported here so plain downloads do not load the tokenizer libraries
+    from llm_driver import read_lines_from_file, encode_data
+
+    lines = read_lines_from_file(filepath, 0, -1)
+    encoded_data = encode_data(lines, tokenizer_type)
+
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    encoded_filepath = os.path.join(ENCODED_FOLDER, f"{name}_{tokenizer_type}.txt")
+    with open(encoded_filepath, "w") as file:
+        file.writelines(" ".join(map(str, token_ids)) + "\n" for token_ids in encoded_data)
+
+    return len(lines), sum(len(token_ids) for token_ids in encoded_data), encoded_filepath
+
+
+async def tokenize_books(queue, tokenizer_type):
+    """
+    Tokenizes downloaded books as they arrive on the queue, until None is received.
+    Tokenization runs in worker processes so it overlaps with the downloads.
+    At most one book per worker is in flight; while all workers are busy the
+    queue fills up and holds back the downloads.
+    """
+    loop = asyncio.get_running_loop()
+    # The basic tokenizer appends to a shared vocabulary file, so it gets a single worker
+    max_workers = 1 if tokenizer_type == "B" else os.cpu_count() or 1
+    os.makedirs(ENCODED_FOLDER, exist_ok=True)
+
+    def report(future):
+        # Called as soon as a book is done, so results and failures show up right away
+        filepath = pending.pop(future)
+        try:
+            num_lines, num_tokens, encoded_filepath = future.result()
+            print(f"Tokenized: {filepath} ({num_lines} lines, {num_tokens} tokens) -> {encoded_filepath}")
+        except Exception as e:
+            print(f"Failed to tokenize {filepath}. Error: {e}")
+
+    pending = {}  # Future -> filepath of the book being tokenized
+    # Spawn fresh workers: forking this process would copy the event loop and its
+    # running threads (aiofiles, DNS resolver) into the child
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_tokenize_worker,
+    ) as executor:
+        while (filepath := await queue.get()) is not None:
+            # Wait for a free worker before taking on another book
+            if len(pending) >= max_workers:
+                await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+            future = loop.run_in_executor(executor, tokenize_book, filepath, tokenizer_type)
+            pending[future] = filepath
+            future.add_done_callback(report)
+
+        # Wait for the books still being tokenized
+        if pending:
+            await asyncio.wait(list(pending))
+
+
+def create_session():
+    """
+    Creates the HTTP session shared by all requests.
+    Connections to gutenberg.org are pooled and kept alive so that each book
+    reuses an open TCP/TLS connection instead of doing a new handshake.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTION_POOL_SIZE,
+        limit_per_host=CONNECTION_POOL_SIZE,
+        force_close=False,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={"Connection": "keep-alive"},
+    )
+
+
+async def run(num_books, retry_count, tokenizer_type=None, use_cache=False):
+    """
+    Fetches random book IDs and downloads the books over a single shared HTTP session.
+    If a tokenizer type is given, each book is tokenized while the others download.
+    If use_cache is True, a recently fetched list of book IDs is reused.
+    """
+    async with create_session() as session:
+        # Fetch random book IDs (fetch extra to account for failures)
+        print("Fetching random book IDs...")
+        book_ids = await fetch_random_book_ids(session, num_books, use_cache)
+        if not book_ids:
+            print("No book IDs found. Please try again later.")
+            return
+
+        print(f"Downloading {num_books} books to '{DOWNLOAD_FOLDER}'...")
+
+        # Download the books
+        if tokenizer_type is None:
+            await download_books(session, book_ids, num_books, retry_count)
+            print("Download complete!")
+            return
+
+        # Download and tokenize the books as a pipeline
+        queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+        async def produce():
+            try:
+                await download_books(session, book_ids, num_books, retry_count, queue)
+                print("Download complete!")
+            finally:
+                await queue.put(None)  # Tell the consumer there are no more books
+
+        await asyncio.gather(produce(), tokenize_books(queue, tokenizer_type))
+        print("Tokenization complete!")
+
+
 def main():
     """
     Main function to execute the book download process.
@@ -133,6 +442,17 @@ def main():
         default=3,
         help="The maximum number of retries for each book if the download fails.",
     )
+    parser.add_argument(
+        "-T", "--tokenizer",
+        type=str,
+        required=False,
+        help="Tokenizer type (B, TIKTOKEN, BPE, WP, SP, ULM, BL-BPE, CHAR, T5) to encode each book as it is downloaded.",
+    )
+    parser.add_argument(
+        "-c", "--cache",
+        action="store_true",
+        help="Reuse the list of random books fetched within the last hour instead of fetching a new one.",
+    )
     args = parser.parse_args()
 
     # Validate the number of books and retry count
@@ -142,22 +462,19 @@ def main():
     if args.retry_count < 0:
         print("Retry count must be a non-negative integer.")
         return
+    if args.tokenizer:
+        # Imported here so plain downloads do not load the tokenizer libraries
+        from do_tokenize import TOKENIZERS
+        if args.tokenizer not in TOKENIZERS:
+            print(f"Unknown tokenizer type: {args.tokenizer}. Available options: {list(TOKENIZERS.keys())}")
+            return
 
-    # Create the download folder if it doesn't exist
+    # Create the download folders if they don't exist
     os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+    os.makedirs(PARTIAL_FOLDER, exist_ok=True)
 
-    # Fetch random book IDs (fetch extra to account for failures)
-    print("Fetching random book IDs...")
-    book_ids = fetch_random_book_ids(args.num_books)
-    if not book_ids:
-        print("No book IDs found. Please try again later.")
-        return
-
-    print(f"Downloading {args.num_books} books to '{DOWNLOAD_FOLDER}'...")
-
-    # Download the books
-    download_books(book_ids, args.num_books, args.retry_count)
-    print("Download complete!")
+    # Fetch the book IDs and download the books
+    asyncio.run(run(args.num_books, args.retry_count, args.tokenizer, args.cache))
 
 
 # Run the main function
@@ -1,60 +1,141 @@
 import argparse
+import atexit
 import re
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from transformers import AutoTokenizer
 from tokenizers import Tokenizer
 import sentencepiece as spm
 import tiktoken 
 
+# Let the Rust-backed tokenizers use all cores for batch encoding
+# (read by the tokenizers library when it first encodes in parallel)
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
+# Minimum number of texts before pure-Python tokenizers are spread over processes
+PARALLEL_MIN_TEXTS = 1000
+
+# Number of processes used for large batches (set to 1 to disable the process pool)
+MAX_WORKERS = os.cpu_count() or 1
+
+def _parallel_map(func, texts):
+    """
+    Apply func to every text, using a process pool for large batches.
+    func must be a module-level function so it can be sent to the workers.
+    """
+    num_workers = MAX_WORKERS
+    if len(texts) < PARALLEL_MIN_TEXTS or num_workers == 1:
+        return [func(text) for text in texts]
+
+    chunksize = max(1, len(texts) // (4 * num_workers))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(func, texts, chunksize=chunksize))
+
+def _char_encode(text):
+    # Use character code points (ASCII values for ASCII text) as token IDs
+    if text.isascii():
+        return list(text.encode("ascii"))
+    return list(map(ord, text))
+
+def _char_decode(token_ids):
+    # IDs below 256 map one-to-one onto latin-1 bytes
+    try:
+        return bytes(token_ids).decode("latin-1")
+    except ValueError:
+        return "".join(map(chr, token_ids))
+
+# Cached tokenizer loaders, so each tokenizer is built once per process
+# instead of on every encode/decode call
+@lru_cache(maxsize=None)
+def _basic_tok():
+    return BasicTokenizer()
+
+@lru_cache(maxsize=None)
+def _cl100k():
+    return tiktoken.get_encoding("cl100k_base")
+
+@lru_cache(maxsize=None)
+def _gpt2_tok():
+    return Tokenizer.from_pretrained("gpt2")
+
+@lru_cache(maxsize=None)
+def _bert_tok():
+    return AutoTokenizer.from_pretrained("bert-base-uncased")
+
+@lru_cache(maxsize=None)
+def _spm(model_file):
+    return spm.SentencePieceProcessor(model_file=model_file)
+
+@lru_cache(maxsize=None)
+def _t5_tok():
+    return AutoTokenizer.from_pretrained("t5-small")
+
 # Top-level dictionary mapping tokenizer types to their encode/decode functions
 TOKENIZERS = {
     "B": {
-        "encode": lambda text: BasicTokenizer().encode(text),
-        "decode": lambda token_ids: BasicTokenizer().decode(token_ids),
+        "encode": lambda text: _basic_tok().encode(text),
+        "encode_batch": lambda texts: _basic_tok().encode_batch(texts),
+        "decode": lambda token_ids: _basic_tok().decode(token_ids),
     },
     "TIKTOKEN": {
-        "encode": lambda text: tiktoken.get_encoding("cl100k_base").encode(text),
-        "decode": lambda token_ids: tiktoken.get_encoding("cl100k_base").decode(token_ids),
+        "encode": lambda text: _cl100k().encode(text),
+        "encode_batch": lambda texts: _cl100k().encode_batch(texts),
+        "decode": lambda token_ids: _cl100k().decode(token_ids),
     },
     "BPE": {
-        "encode": lambda text: Tokenizer.from_pretrained("gpt2").encode(text).ids,
-        "decode": lambda token_ids: Tokenizer.from_pretrained("gpt2").decode(token_ids),
+        "encode": lambda text: _gpt2_tok().encode(text).ids,
+        "encode_batch": lambda texts: [encoding.ids for encoding in _gpt2_tok().encode_batch(texts)],
+        "decode": lambda token_ids: _gpt2_tok().decode(token_ids),
     },
     "WP": {
-        "encode": lambda text: AutoTokenizer.from_pretrained("bert-base-uncased")(text)["input_ids"],
-        "decode": lambda token_ids: AutoTokenizer.from_pretrained("bert-base-uncased").decode(token_ids),
+        "encode": lambda text: _bert_tok()(text)["input_ids"],
+        "encode_batch": lambda texts: _bert_tok()(texts, add_special_tokens=True)["input_ids"],
+        "decode": lambda token_ids: _bert_tok().decode(token_ids),
     },
     "SP": {
-        "encode": lambda text: spm.SentencePieceProcessor(model_file="spm.model").encode_as_ids(text),
-        "decode": lambda token_ids: spm.SentencePieceProcessor(model_file="spm.model").decode_ids(token_ids),
+        "encode": lambda text: _spm("spm.model").encode_as_ids(text),
+        "encode_batch": lambda texts: _spm("spm.model").encode(texts, out_type=int),
+        "decode": lambda token_ids: _spm("spm.model").decode_ids(token_ids),
     },
     "ULM": {
-        "encode": lambda text: spm.SentencePieceProcessor(model_file="ulm.model").encode_as_ids(text),
-        "decode": lambda token_ids: spm.SentencePieceProcessor(model_file="ulm.model").decode_ids(token_ids),
+        "encode": lambda text: _spm("ulm.model").encode_as_ids(text),
+        "encode_batch": lambda texts: _spm("ulm.model").encode(texts, out_type=int),
+        "decode": lambda token_ids: _spm("ulm.model").decode_ids(token_ids),
     },
     "BL-BPE": {
-        "encode": lambda text: Tokenizer.from_pretrained("gpt2").encode(text).ids,
-        "decode": lambda token_ids: Tokenizer.from_pretrained("gpt2").decode(token_ids),
+        "encode": lambda text: _gpt2_tok().encode(text).ids,
+        "encode_batch": lambda texts: [encoding.ids for encoding in _gpt2_tok().encode_batch(texts)],
+        "decode": lambda token_ids: _gpt2_tok().decode(token_ids),
     },
     "CHAR": {
-        "encode": lambda text: [ord(char) for char in text],  # Use ASCII values as token IDs
-        "decode": lambda token_ids: "".join([chr(token_id) for token_id in token_ids]),
+        "encode": _char_encode,
+        # Runs inline: shipping the ID lists back from worker processes costs more than encoding
+        "encode_batch": lambda texts: [_char_encode(text) for text in texts],
+        "decode": _char_decode,
     },
     "T5": {
-        "encode": lambda text: AutoTokenizer.from_pretrained("t5-small")(text)["input_ids"],
-        "decode": lambda token_ids: AutoTokenizer.from_pretrained("t5-small").decode(token_ids),
+        "encode": lambda text: _t5_tok()(text)["input_ids"],
+        "encode_batch": lambda texts: _t5_tok()(texts, add_special_tokens=True)["input_ids"],
+        "decode": lambda token_ids: _t5_tok().decode(token_ids),
     },
 }
 
 # Basic Tokenizer Class
 class BasicTokenizer:
+    # Regex used to split text into tokens
+    _SPLIT_RE = re.compile(r'([,.:;?_!"()\']|--|\s)')
+
     def __init__(self):
         self.vocab = []  # Vocabulary (list of tokens)
         self.token_to_id = {}  # Token to ID mapping
         self.id_to_token = {}  # ID to token mapping
-        self.vocab_file = "./data/vocabulary/basictokenizer_vocab.json"
+        self.vocab_file = "./data/vocabulary/basictokenizer_vocab.txt"  # One token per line
+        self._legacy_vocab_file = "./data/vocabulary/basictokenizer_vocab.json"
+        self._dirty = False  # True when the vocabulary has unsaved tokens
+        self._saved_count = 0  # Number of tokens already in the vocabulary file
         
         # Add special tokens to the vocabulary
         self.special_tokens = {
@@ -68,11 +149,27 @@ class BasicTokenizer:
         
         # Load vocabulary from file if it exists
         if os.path.exists(self.vocab_file):
-            with open(self.vocab_file, "r") as f:
+            with open(self.vocab_file, "rb") as f:
+                content = f.read()
+            # Only lines ending in a newline are complete; anything after the last
+            # newline is left over from an interrupted append (possibly cut inside
+            # a multi-byte character), so it is dropped before decoding
+            complete = content[:content.rfind(b"\n") + 1]
+            self.vocab = complete.decode("utf-8").split("\n")[:-1]
+            self.token_to_id = {token: idx for idx, token in enumerate(self.vocab)}
+            self.id_to_token = {idx: token for idx, token in enumerate(self.vocab)}
+            if len(complete) < len(content):
+                self.save_vocab()
+            self._saved_count = len(self.vocab)
+        elif os.path.exists(self._legacy_vocab_file):
+            # Convert a vocabulary saved in the old JSON format
+            with open(self._legacy_vocab_file, "r") as f:
                 self.vocab = json.load(f)
-                self.token_to_id = {token: idx for idx, token in enumerate(self.vocab)}
-                self.id_to_token = {idx: token for idx, token in enumerate(self.vocab)}
-        else:
+            self.token_to_id = {token: idx for idx, token in enumerate(self.vocab)}
+            self.id_to_token = {idx: token for idx, token in enumerate(self.vocab)}
+            self.save_vocab()
+
+        if not self.vocab:
             # Initialize vocabulary with special tokens
             for token in self.special_tokens:
                 self.vocab.append(token)
@@ -80,46 +177,106 @@ class BasicTokenizer:
                 self.id_to_token[len(self.vocab) - 1] = token
             self.save_vocab()  # Save the initial vocabulary
 
+        # Make sure tokens added by encode() reach the vocabulary file
+        atexit.register(self.flush_vocab)
+
     def save_vocab(self):
         """
-        Save the current vocabulary to the vocabulary file.
+        Save the whole vocabulary to the vocabulary file, one token per line.
+        The file is replaced atomically so a crash never leaves it half written.
         """
-        with open(self.vocab_file, "w") as f:
-            json.dump(self.vocab, f)
+        tmp_file = self.vocab_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.writelines(f"{token}\n" for token in self.vocab)
+        os.replace(tmp_file, self.vocab_file)
+        self._saved_count = len(self.vocab)
+        self._dirty = False
 
-    def encode(self, text, vocab_update=True):
+    def flush_vocab(self):
         """
-        Encode text into token IDs using a basic regex-based tokenizer.
-        If vocab_update is True, update the vocabulary file with new tokens.
+        Append tokens added since the last save to the vocabulary file.
+        Tokens never contain whitespace, so one token per line is unambiguous.
+        The append is synced to disk; a line cut short by a crash is dropped on load.
+        """
+        if not self._dirty:
+            return
+        with open(self.vocab_file, "a", encoding="utf-8") as f:
+            f.writelines(f"{token}\n" for token in self.vocab[self._saved_count:])
+            f.flush()
+            os.fsync(f.fileno())
+        self._saved_count = len(self.vocab)
+        self._dirty = False
+
+    @staticmethod
+    def split_text(text):
+        """
+        Split text into tokens using a basic regex-based tokenizer.
+        The tokens are wrapped in <|BOS|> and <|EOS|>.
         """
         # Add <|BOS|> at the start and <|EOS|> at the end
         tokens = ["<|BOS|>"]
         
         # Split text using regex
-        text_tokens = re.split(r'([,.:;?_!"()\']|--|\s)', text)
+        parts = BasicTokenizer._SPLIT_RE.split(text)
         # Remove empty strings and strip whitespace
-        text_tokens = [item.strip() for item in text_tokens if item.strip()]
-        tokens.extend(text_tokens)
+        tokens.extend(item for item in (part.strip() for part in parts) if item)
         
         # Add <|EOS|> at the end
         tokens.append("<|EOS|>")
+        return tokens
+
+    def encode(self, text, vocab_update=True):
+        """
+        Encode text into token IDs using a basic regex-based tokenizer.
+        If vocab_update is True, new tokens are written to the vocabulary file
+        on the next flush_vocab() call (at the latest when the process exits).
+        """
+        token_ids, new_tokens = self._to_ids(self.split_text(text))
+        
+        # Mark the vocabulary for saving if new tokens were added
+        if vocab_update and new_tokens:
+            self._dirty = True
+        
+        return token_ids
+
+    def encode_batch(self, texts, vocab_update=True):
+        """
+        Encode a list of texts into lists of token IDs.
+        Splitting runs in parallel for large batches; token IDs are assigned
+        here in input order so the vocabulary stays consistent.
+        If vocab_update is True, update the vocabulary file once with new tokens.
+        """
+        encoded = []
+        for tokens in _parallel_map(BasicTokenizer.split_text, texts):
+            token_ids, new_tokens = self._to_ids(tokens)
+            encoded.append(token_ids)
+            if vocab_update and new_tokens:
+                self._dirty = True
         
+        # Update vocabulary file once for the whole batch
+        self.flush_vocab()
+        
+        return encoded
+
+    def _to_ids(self, tokens):
+        """
+        Map tokens to IDs, adding unknown tokens to the vocabulary.
+        Returns the token IDs and the list of newly added tokens.
+        """
         # Update vocabulary and token-to-ID mappings
+        get_id = self.token_to_id.get
         token_ids = []
         new_tokens = []
         for token in tokens:
-            if token not in self.token_to_id:
+            token_id = get_id(token)
+            if token_id is None:
+                token_id = len(self.vocab)
                 self.vocab.append(token)
-                self.token_to_id[token] = len(self.vocab) - 1
-                self.id_to_token[len(self.vocab) - 1] = token
+                self.token_to_id[token] = token_id
+                self.id_to_token[token_id] = token
                 new_tokens.append(token)
-            token_ids.append(self.token_to_id[token])
-        
-        # Update vocabulary file if new tokens were added
-        if vocab_update and new_tokens:
-            self.save_vocab()
-        
-        return token_ids
+            token_ids.append(token_id)
+        return token_ids, new_tokens
 
     def decode(self, token_ids):
         """
@@ -132,24 +289,39 @@ class BasicTokenizer:
 
 
 
-def encode_text(text, tokenizer_type):
+def get_tokenizer_function(tokenizer_type, operation):
     """
-    Encode the input text using the specified tokenizer.
+    Look up the function for an operation ("encode", "encode_batch" or "decode")
+    of the specified tokenizer, so callers can resolve it once outside their loops.
     """
     if tokenizer_type not in TOKENIZERS:
         raise ValueError(f"Unknown tokenizer type: {tokenizer_type}. Available options: {list(TOKENIZERS.keys())}")
     
-    encode_func = TOKENIZERS[tokenizer_type]["encode"]
+    return TOKENIZERS[tokenizer_type][operation]
+
+def encode_text(text, tokenizer_type):
+    """
+    Encode the input text using the specified tokenizer.
+    """
+    encode_func = get_tokenizer_function(tokenizer_type, "encode")
     return encode_func(text)
 
+def encode_batch(texts, tokenizer_type):
+    """
+    Encode a list of texts using the specified tokenizer in a single call.
+    Returns one list of token IDs per input text.
+    """
+    encode_batch_func = get_tokenizer_function(tokenizer_type, "encode_batch")
+    if not texts:
+        return []
+
+    return encode_batch_func(list(texts))
+
 def decode_text(token_ids, tokenizer_type):
     """
     Decode the input token IDs using the specified tokenizer.
     """
-    if tokenizer_type not in TOKENIZERS:
-        raise ValueError(f"Unknown tokenizer type: {tokenizer_type}. Available options: {list(TOKENIZERS.keys())}")
-    
-    decode_func = TOKENIZERS[tokenizer_type]["decode"]
+    decode_func = get_tokenizer_function(tokenizer_type, "decode")
     return decode_func(token_ids)
 
 def main():
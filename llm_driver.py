@@ -1,51 +1,48 @@
 import argparse
+import itertools
+import mmap
 import os
 from pathlib import Path
 
 # Import tokenizer functions from the previous script
-from do_tokenize import encode_text, decode_text
+from do_tokenize import encode_batch, get_tokenizer_function
 
 def read_lines_from_file(file_path, start_line, end_line):
     """
     Read lines from a text file between start_line and end_line.
     If end_line is -1, read until the end of the file.
+    The file is memory-mapped and only the selected lines are decoded.
     """
-    with open(file_path, "r") as f:
-        lines = f.readlines()
-    
-    # Adjust start_line and end_line based on file length
+    # Adjust start_line and end_line
     if start_line < 0:
         start_line = 0
-    if end_line == -1 or end_line >= len(lines):
-        end_line = len(lines)
+    if end_line == -1:
+        end_line = None
     
     # Ensure start_line is less than end_line
-    if start_line >= end_line:
+    if end_line is not None and start_line >= end_line:
         return []
     
-    # Read the specified lines
-    selected_lines = lines[start_line:end_line]
-    return [line.strip() for line in selected_lines if line.strip()]
+    # Memory-map the file and decode only the specified lines
+    if os.path.getsize(file_path) == 0:
+        return []
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        selected_lines = itertools.islice(iter(mm.readline, b""), start_line, end_line)
+        return [line for line in (line.decode("utf-8").strip() for line in selected_lines) if line]
 
 def encode_data(lines, tokenizer_type):
     """
     Encode a list of text lines using the specified tokenizer.
     """
-    encoded_data = []
-    for line in lines:
-        token_ids = encode_text(line, tokenizer_type)
-        encoded_data.append(token_ids)
-    return encoded_data
+    return encode_batch(lines, tokenizer_type)
 
 def decode_data(encoded_data, tokenizer_type):
     """
     Decode a list of token IDs using the specified tokenizer.
     """
-    decoded_data = []
-    for token_ids in encoded_data:
-        text = decode_text(token_ids, tokenizer_type)
-        decoded_data.append(text)
-    return decoded_data
+    # Resolve the tokenizer once instead of on every line
+    decode_func = get_tokenizer_function(tokenizer_type, "decode")
+    return [decode_func(token_ids) for token_ids in encoded_data]
 
 def display(data, data_type, start_line, pretty=False):
     """